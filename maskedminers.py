@@ -17,17 +17,27 @@ https://www.useragents.me/#most-common-desktop-useragents
 """
 
 
+import codecs
 import gzip
-import io
+import itertools
 from json import dumps, loads
+import lxml.etree as LxmlEtree
 import lxml.html as LxmlHtml
 import os
 import random
+import re
 from sukhoi import Miner, MinerLXML
 import sys
 import time
 from untwisted import core
 from websnake import FormData, Response
+try:                                    # C-backed JSON decoder for data we control
+    from orjson import loads as fast_loads
+except ImportError:
+    try:
+        from ujson import loads as fast_loads
+    except ImportError:
+        fast_loads = loads
 
 
 class UserAgentMiner(MinerLXML):
@@ -36,6 +46,15 @@ class UserAgentMiner(MinerLXML):
     This can safely be done without masking.
     """
     
+    # Pre-compiled XPath expressions for finding the data
+    _SECTION_XP = LxmlEtree.XPath('//div[@id="most-common-desktop-useragents-json-csv"]')
+    _DIVS_XP = LxmlEtree.XPath('.//div')
+    _H3_XP = LxmlEtree.XPath('.//h3')
+    _TA_XP = LxmlEtree.XPath('.//textarea')
+    
+    # Pattern for picking the data out of a chunked response
+    _CHUNKED_JSON_RE = re.compile(rb'<h3>JSON</h3>.*?<textarea[^>]*>(.*?)</textarea>', re.DOTALL)
+    
     def __init__(self, filename:str):
         """
         Constructor.
@@ -45,7 +64,7 @@ class UserAgentMiner(MinerLXML):
         self.filename = filename
         url = 'https://www.useragents.me/'
         headers = {
-            'connection': 'close',
+            'connection': 'close',  # the chunked body is read until the socket closes
             'user-agent': 'Updater Bot'
         }
         super().__init__(url, headers)
@@ -74,12 +93,12 @@ class UserAgentMiner(MinerLXML):
         json_str = ''
         
         # Find the data
-        section = dom.xpath('//div[@id="most-common-desktop-useragents-json-csv"]')[0]
-        type_regions = section.xpath('.//div')
+        section = self._SECTION_XP(dom)[0]
+        type_regions = self._DIVS_XP(section)
         for region in type_regions:
-            type_name = region.xpath('.//h3')[0].text
+            type_name = self._H3_XP(region)[0].text
             if type_name == 'JSON':
-                json_str = region.xpath('.//textarea')[0].text
+                json_str = self._TA_XP(region)[0].text
                 break
         if json_str == '':  # data not found
             raise ValueError('The JSON data could not be found!')
@@ -105,13 +124,11 @@ class UserAgentMiner(MinerLXML):
         :param bytes data: The content of the response.
         """
         
-        data_str = data.decode()    # convert to str
-        
-        try:    # pick out data
-            json_str = data_str.split('<h3>JSON</h3>', 1)[1].split('<textarea', 1)[1].split('>', 1)[1].split('</textarea>', 1)[0]
-        except: # unexpected data format!
-            print('Unfamiliar response data:', data_str, file=sys.stderr)
+        m = self._CHUNKED_JSON_RE.search(data)  # pick out data
+        if not m:                               # unexpected data format!
+            print('Unfamiliar response data:', data.decode('utf-8', errors='replace'), file=sys.stderr)
             raise NotImplementedError('The user-agents data could not be found!')
+        json_str = m.group(1).decode('utf-8')   # convert only the data to str
         
         self.write(json_str)
         self.append(json_str)
@@ -130,7 +147,7 @@ class Browser:
     SAFARI = 5
     
     __brands = [None, 'Google Chrome', 'Microsoft Edge', None, 'Opera', None]
-    __keywords = ['', 'Chrome', 'Edg', 'Firefox', 'OPR', 'Safari']
+    _UA_RE = re.compile(r'(Firefox|Edg|OPR|Chrome|Safari)/(\d+)')    # browser keywords and major versions
     
     def __init__(self, ua:str):
         """
@@ -143,37 +160,30 @@ class Browser:
         self.chromium_version = -1  # remains -1 when the browser is not known to use chromium
         
         # Determine browser indicated by the user-agent
-        k = self.__keywords[Browser.FIREFOX]
-        i = ua.find(k)
-        if i >= 0:  # indicates Firefox
+        hits = dict(self._UA_RE.findall(ua))    # keyword -> major version
+        if 'Firefox' in hits:   # indicates Firefox
             self.type = Browser.FIREFOX
-            self.version = int(ua[i + len(k) + 1:].split('.', 1)[0])
+            self.version = int(hits['Firefox'])
         else:
-            for b in [Browser.EDGE, Browser.OPERA]:
-                k = self.__keywords[b]
-                i = ua.find(k)
-                if i >= 0:  # indicates Edge or Opera
+            for b, k in [(Browser.EDGE, 'Edg'), (Browser.OPERA, 'OPR')]:
+                if k in hits:   # indicates Edge or Opera
                     self.type = b
-                    self.version = int(ua[i + len(k) + 1:].split('.', 1)[0])
+                    self.version = int(hits[k])
                     break
-            k = self.__keywords[Browser.CHROME]
-            i = ua.find(k)
-            if i >= 0:  # indicates usage of Chromium
-                self.chromium_version = int(ua[i + len(k) + 1:].split('.', 1)[0])
+            if 'Chrome' in hits:    # indicates usage of Chromium
+                self.chromium_version = int(hits['Chrome'])
                 if self.type == Browser.NONE:   # indicates Chrome
                     self.type = Browser.CHROME
                     self.version = self.chromium_version
-            else:
-                k = self.__keywords[Browser.SAFARI]
-                i = ua.find(k)
-                if i >= 0:  # indicates Safari
-                    self.type = Browser.SAFARI
-                    self.version = int(ua[i + len(k) + 1:].split('.', 1)[0])
+            elif 'Safari' in hits:  # indicates Safari
+                self.type = Browser.SAFARI
+                self.version = int(hits['Safari'])
         
         # Set branding data
         if self.uses_chromium():    # needs branding
             misc = ['', ' ', '_', ';', '(', ')']    # assumed from observations
-            fake_brand = f'{random.choice(misc)}Not{random.choice(misc)}A{random.choice(misc)}Brand'    # assumed from observations
+            s1, s2, s3 = random.choices(misc, k=3)
+            fake_brand = f'{s1}Not{s2}A{s3}Brand'   # assumed from observations
             fake_version = random.randint(1, 100)   # assumed from observations
             brands = [
                 (fake_brand, fake_version),
@@ -181,7 +191,7 @@ class Browser:
                 ('Chromium', self.chromium_version)
             ]
             random.shuffle(brands)  # not yet observed, but follows documentation
-            self.branding = ', '.join(list(map(lambda brand: f'"{brand[0]}"; v="{brand[1]}"', brands)))
+            self.branding = ', '.join(f'"{name}"; v="{ver}"' for name, ver in brands)
         else:
             self.branding = ''  # unused
     
@@ -199,6 +209,11 @@ class Platform:
     A platform operated upon by an emulated browser.
     """
     
+    _PAREN_RE = re.compile(r'\(([^)]*)\)')                  # system info section
+    _WIN_RE = re.compile(r'^((Windows) ([^;]*))')           # type, OS, and OS version
+    _MAC_RE = re.compile(r'(\w[^;]*Mac OS X) ([\d_.]+)')    # OS and OS version
+    _X11_RE = re.compile(r'X11; (\w+)')                     # OS
+    
     def __init__(self, ua:str):
         """
         Constructor.
@@ -211,62 +226,94 @@ class Platform:
         
         if len(ua) > 0:
             self.is_mobile = False
-            system_info = ua.split('(', 1)[1].split(')', 1)[0]
-            if 'Windows' in system_info:
-                self.type = system_info.split(';', 1)[0]
-                self.os, self.os_version = system_info.split(' ', 1)
+            m = self._PAREN_RE.search(ua)
+            system_info = m.group(1) if m else ''
+            if m := self._WIN_RE.match(system_info):
+                self.type, self.os, self.os_version = m.groups()
             elif 'Macintosh' in system_info:    # unverified random guess
                 self.type = 'Macintosh'
-                self.os, self.os_version = system_info.split('; ', 1)[1].rsplit(' ', 1)
-            elif 'X11' in system_info:          # unverified random guess
+                if m := self._MAC_RE.search(system_info):
+                    self.os, self.os_version = m.groups()
+            elif m := self._X11_RE.search(system_info): # unverified random guess
                 self.type = 'Linux'
-                self.os = system_info.split(' ', 2)[1].strip(';')
+                self.os = m.group(1)
             else:                               # some new unparseable case
-                print(f'System info section of user-agent cannot be parsed! ({system_info})', sys.stderr)
-                self.type = ua.split(' ', 1)[0]
+                print(f'System info section of user-agent cannot be parsed! ({system_info})', file=sys.stderr)
+                self.type = ua.partition(' ')[0]
         else:                                   # empty
-            print('The user-agent is empty!', sys.stderr)
+            print('The user-agent is empty!', file=sys.stderr)
+
+
+# Storage for all potential user-agents, filled by Environment.load_content
+# Setting 'ready' to False makes the next Environment reload the data file
+_UA_STATE = {
+    'ready': False,         # whether the user-agents have been loaded
+    'envs': None,           # parsed (user-agent, Browser, Platform, headers) for each option
+    'cum_weights': None     # cumulative probabilities of the user-agents
+}
 
 
 class Environment:
     """
     An emulated environment for masking.
-    Also holds all potential user-agents.
+    All potential user-agents are held in the module-level _UA_STATE; the
+    former Environment.ready, uas, and pcts attributes were removed.
     """
     
     __SEC_DAY = 86400               # seconds per day
     __UA_FILE = 'user-agent.json'   # file holding user-agent data
     updated = False                 # whether the user-agents have been updated
-    ready = False                   # whether the user-agents have been loaded
-    uas:list                        # storage for user-agent options
-    pcts:list                       # stores probabilities of the user-agents
+    _cached_mtime = None            # last known modification time of the user-agents data file
     
     def __init__(self):
         """
         Constructor for a random common environment.
         """
         
-        if not Environment.ready:   # if not pre-loaded
+        if not _UA_STATE['ready']:  # if not pre-loaded
             content:str
             with open(Environment.__UA_FILE, 'r') as file:
                 content = file.readline()
             Environment.load_content(content)
         
         # Set fields
-        self.ua = random.choices(self.uas, self.pcts)[0]
-        self.browser = Browser(self.ua)
-        self.platform = Platform(self.ua)
+        self.ua, self.browser, self.platform, self.base_headers = random.choices(_UA_STATE['envs'], cum_weights=_UA_STATE['cum_weights'])[0]
         
     def load_content(content:str):
         """
-        Fill user-agents' and probabilities' storages from JSON data.
+        Fill the user-agent storage from JSON data.
+        Each user-agent is parsed once here, so its Browser branding (fake
+        brand and brand order) stays the same until the data is reloaded.
         :param str content: A JSON string with the data.
         """
         
-        agents = loads(content)
-        Environment.uas = list(map(lambda agent: agent['ua'], agents))
-        Environment.pcts = list(map(lambda agent: agent['pct'], agents))
-        Environment.ready = True
+        agents = fast_loads(content)
+        uas = list(map(lambda agent: agent['ua'], agents))
+        pcts = list(map(lambda agent: agent['pct'], agents))
+        _UA_STATE['cum_weights'] = list(itertools.accumulate(pcts))
+        _UA_STATE['envs'] = list(map(Environment.build_env, uas))  # parse each user-agent once
+        _UA_STATE['ready'] = True
+    
+    def build_env(ua:str) -> tuple:
+        """
+        Parse a user-agent and build the header values shared by every miner using it.
+        The headers dict is shared, so it must not be modified.
+        :param str ua: A user-agent string.
+        :returns tuple: The user-agent, its Browser, its Platform, and its headers.
+        """
+        
+        browser = Browser(ua)
+        platform = Platform(ua)
+        headers = {
+            'accept-language': 'en-US,en;q=0.9',
+            'dnt': '1',
+            'user-agent': ua
+        }
+        if browser.uses_chromium():
+            headers['sec-ch-ua'] = browser.branding
+            headers['sec-ch-ua-mobile'] = f'?{int(platform.is_mobile)}'
+            headers['sec-ch-ua-platform'] = f'"{platform.type}"'
+        return ua, browser, platform, headers
     
     def needs_update() -> bool:
         """
@@ -277,7 +324,9 @@ class Environment:
         
         if Environment.updated:
             return False
-        last_update = os.path.getmtime(Environment.__UA_FILE)
+        if Environment._cached_mtime is None:   # only stat the file once per process
+            Environment._cached_mtime = os.path.getmtime(Environment.__UA_FILE)
+        last_update = Environment._cached_mtime
         yesterday = time.time() - Environment.__SEC_DAY
         return last_update < yesterday
     
@@ -292,6 +341,7 @@ class Environment:
         content = miner[0]
         Environment.load_content(content)   # pre-loads
         Environment.updated = True
+        Environment._cached_mtime = time.time()
 
     def setup(force:bool = False) -> bool:
         """
@@ -312,9 +362,12 @@ class MaskedMiner(Miner):
     A Miner that masks itself with headers.
     """
     
-    def __init__(self, url:str, headers:dict = {}, method='get', payload:dict = None, attempts=5, environment:Environment = None):
+    def __init__(self, url:str, headers:dict = None, method='get', payload:dict = None, attempts=5, environment:Environment = None):
         """
         Constructor.
+        Given headers take priority over the environment's, except that every
+        sec-ch-ua* header (in any case) is dropped when the environment's
+        browser does not use Chromium.
         :param str url: The URL to mine.
         :param dict headers: The headers for the request.
         :param str method: The type of request to send.
@@ -329,17 +382,10 @@ class MaskedMiner(Miner):
             self.environment = environment
         
         # Headers
-        headers.setdefault('accept-language', 'en-US,en;q=0.9')
-        headers.setdefault('dnt', '1')
-        headers.setdefault('user-agent', self.environment.ua)
-        if self.environment.browser.uses_chromium():
-            headers.setdefault('sec-ch-ua', self.environment.browser.branding)
-            headers.setdefault('sec-ch-ua-mobile', f'?{int(self.environment.platform.is_mobile)}')
-            headers.setdefault('sec-ch-ua-platform', f'"{self.environment.platform.type}"')
-        else:
-            for header in list(headers.keys()):
-                if header.lower().startswith('sec-'):
-                    del headers[header]
+        headers = {} if headers is None else headers
+        if not self.environment.browser.uses_chromium():    # client hints are Chromium-only
+            headers = {k: v for k, v in headers.items() if not k.lower().startswith('sec-ch-ua')}
+        headers = {**self.environment.base_headers, **headers}  # given headers take priority
         
         # Payload
         form = self.form_payload(payload)
@@ -354,43 +400,42 @@ class MaskedMiner(Miner):
         
         self.response = response
         
-        data = response.fd.read()                   # get encoded content
-        response.fd.seek(0)                         # allow to get again later
+        data = self.read_content(response)          # get content without gzip layer
         encoding = response.header_encoding()       # determine encoding
         if encoding is not None:                    # data needs decoding
-            try:                                    # attempt to get text
-                temp = data.decode(encoding)        # will fail on extra encoding layer like gzip (assumed)
-                data = temp
-            except UnicodeDecodeError:              # still gzip encoded (in observations)
-                data = self.backup_decoding(data)
+            data = data.decode(encoding)
         else:
             data = str(data)
         
         self.build_dom(data)
     
-    def backup_decoding(self, data:bytes) -> str:
+    def read_content(self, response:Response) -> bytes:
         """
-        If decoding fails, try this instead.
-        This assumes that the data is still gzip encoded.
-        :param bytes data: Encoded input.
-        :returns str: Decoded output.
+        Read the content of the response, removing a gzip layer if present.
+        Gzip is detected by its magic bytes since servers have been observed
+        to send it without declaring it.
+        :param Response response: The HTTP response.
+        :returns bytes: The content, still in its charset.
         """
         
-        s:str
-        buf = io.BytesIO(data)
-        with gzip.GzipFile(fileobj=buf) as f:
-            s = f.read().decode('utf-8')         # decode gzip to text
-        return s
+        data = response.fd.read()           # get encoded content
+        response.fd.seek(0)                 # allow to get again later
+        if data[:2] == b'\x1f\x8b':  # still gzip encoded
+            data = gzip.decompress(data)
+        return data
     
     def form_payload(self, dict_payload:dict) -> FormData:
         """
         Transform a dict payload to a FormData instance.
         FormData is the payload type required by the "websnake" module.
+        A FormData that was already prepared is used as-is.
+        :param dict_payload: A dict payload, a prepared FormData, or None.
+        :returns FormData: The payload for the request.
         """
         
-        if dict_payload is None:
-            return None
-        prep_payload = dict(zip(dict_payload, map(dumps, dict_payload.values())))
+        if dict_payload is None or isinstance(dict_payload, FormData):
+            return dict_payload
+        prep_payload = {k: dumps(v) for k, v in dict_payload.items()}
         return FormData(prep_payload)
 
 
@@ -399,7 +444,7 @@ class MaskedMinerJSON(MaskedMiner):
     A MaskedMiner for HTTP endpoints that provide JSON responses.
     """
     
-    def __init__(self, url, headers:dict = {}, method='get', payload:dict = None, attempts=5, environment:Environment = None):
+    def __init__(self, url, headers:dict = None, method='get', payload:dict = None, attempts=5, environment:Environment = None):
         """
         Constructor.
         :param str url: The URL to mine.
@@ -410,14 +455,33 @@ class MaskedMinerJSON(MaskedMiner):
         :param Environment environment: The emulated environment for the calls, used to set header data.
         """
         
+        headers = {} if headers is None else dict(headers)
         headers.setdefault('accept', 'application/json')
         headers.setdefault('accept-encoding', 'gzip, deflate, br')
         super().__init__(url, headers, method, payload, attempts, environment)
     
-    def build_dom(self, data:str):
+    def setup(self, response:Response):
+        """
+        Prepare to read the response.
+        UTF-8 content goes straight to the decoder without an intermediate str.
+        :param Response response: The HTTP response.
+        """
+        
+        self.response = response
+        
+        data = self.read_content(response)          # get content without gzip layer
+        encoding = response.header_encoding()       # determine encoding
+        if encoding is not None and codecs.lookup(encoding).name != 'utf-8':
+            data = data.decode(encoding)            # JSON decoder only detects UTF encodings in bytes
+        
+        self.build_dom(data)
+    
+    def build_dom(self, data):
         """
         Read the response content for mining.
-        :param str data: A string containing the JSON data.
+        This uses the standard json decoder rather than orjson/ujson, which
+        lose precision on integers beyond 64 bits and reject NaN.
+        :param data: A str or bytes containing the JSON data.
         """
         
         dom = loads(data)
@@ -429,7 +493,7 @@ class MaskedMinerLXML(MaskedMiner):
     A MaskedMiner for HTTP endpoints that provide HTML responses.
     """
     
-    def __init__(self, url, headers:dict = {}, method='get', payload:FormData = None, attempts=5, environment:Environment = None):
+    def __init__(self, url, headers:dict = None, method='get', payload:FormData = None, attempts=5, environment:Environment = None):
         """
         Constructor.
         :param str url: The URL to mine.
@@ -440,6 +504,7 @@ class MaskedMinerLXML(MaskedMiner):
         :param Environment environment: The emulated environment for the calls, used to set header data.
         """
         
+        headers = {} if headers is None else dict(headers)
         headers.setdefault('accept', 'text/html')
         headers.setdefault('accept-encoding', 'gzip, deflate, br')
         super().__init__(url, headers, method, payload, attempts, environment)